@@ -1,13 +1,15 @@
 from fastapi import FastAPI, Request, Depends, Form, HTTPException, Response
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse
 from sqlalchemy import create_engine, Column, Integer, String, Date, Boolean, func, DateTime, ForeignKey, Float
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship, joinedload
 from pydantic import BaseModel, EmailStr
 from typing import Optional
 from datetime import date, datetime
+import math
 import uvicorn
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 import graphene
 from graphene import ObjectType,  List, Schema
 from graphene import String as GString
@@ -88,14 +90,66 @@ EXERCISE_LOOKUP_DB = {
     # 5.23 calories per minute (3.5 mph)
 }
 
+# Saved recipes/meals: (user_id, name) -> list of (food, gram).
+# Kept in process memory only, so they are lost on restart and not shared between workers.
+RECIPE_LOOKUP_DB = {}
+
+# Precomputed recipe calories: (user_id, name) -> totals, per-gram density and per-item calories.
+# Entries are dropped whenever the recipe is replaced or deleted, or a constituent food changes.
+RECIPE_CALORIE_CACHE = {}
+
+
+def get_recipe_calories(user_id, recipe_name):
+    recipe_key = (user_id, recipe_name)
+    cached = RECIPE_CALORIE_CACHE.get(recipe_key)
+    if cached is not None:
+        return cached
+    items = RECIPE_LOOKUP_DB.get(recipe_key)
+    if items is None:
+        return None
+
+    item_calories = []
+    total_gram = 0.0
+    total_calories = 0.0
+    for food, gram in items:
+        cal = FOOD_LOOKUP_DB[food]["unit_calorie_g"] * gram
+        item_calories.append((food, gram, cal))
+        total_gram += gram
+        total_calories += cal
+
+    cached = {
+        "items": item_calories,
+        "total_gram": total_gram,
+        "total_calories": total_calories,
+        "unit_calorie_g": total_calories / total_gram,
+    }
+    RECIPE_CALORIE_CACHE[recipe_key] = cached
+    return cached
+
+
+def invalidate_recipe_calories(food_type):
+    for recipe_key, items in RECIPE_LOOKUP_DB.items():
+        if any(food == food_type for food, _ in items):
+            RECIPE_CALORIE_CACHE.pop(recipe_key, None)
+
+
 class FoodItem(ObjectType):
     food_type = GString()
     unit_calorie_g = GFloat()
 
+class RecipeItem(ObjectType):
+    name = GString()
+    total_gram = GFloat()
+    total_calories = GFloat()
+    unit_calorie_g = GFloat()
+
 # Query Class
 class Query(ObjectType):
     list_all_foods = List(GString)
     get_unit_calories = graphene.Field(GFloat, food_type=graphene.Argument(GString))
+    list_all_recipes = List(GString, user_id=graphene.Argument(graphene.Int, required=True))
+    get_recipe_unit_calories = graphene.Field(GFloat, user_id=graphene.Argument(graphene.Int, required=True),
+                                              name=graphene.Argument(GString))
 
     def resolve_list_all_foods(root, info):
         return list(FOOD_LOOKUP_DB.keys())
@@ -106,6 +160,15 @@ class Query(ObjectType):
             return food_data['unit_calorie_g']
         return None
 
+    def resolve_list_all_recipes(root, info, user_id):
+        return [name for owner_id, name in RECIPE_LOOKUP_DB if owner_id == user_id]
+
+    def resolve_get_recipe_unit_calories(root, info, user_id, name):
+        recipe_data = get_recipe_calories(user_id, name)
+        if recipe_data:
+            return recipe_data['unit_calorie_g']
+        return None
+
 # Mutation Class
 class CreateFoodItem(graphene.Mutation):
     class Arguments:
@@ -116,11 +179,61 @@ class CreateFoodItem(graphene.Mutation):
 
     def mutate(self, info, food_type, unit_calorie_g):
         FOOD_LOOKUP_DB[food_type] = {"unit_calorie_g": unit_calorie_g}
+        invalidate_recipe_calories(food_type)
         return CreateFoodItem(food_item=FoodItem(food_type=food_type, unit_calorie_g=unit_calorie_g))
 
+class CreateRecipe(graphene.Mutation):
+    class Arguments:
+        user_id = graphene.Int(required=True)
+        name = GString(required=True)
+        foods = List(GString, required=True)
+        grams = List(GFloat, required=True)
+        replace = graphene.Boolean()
+
+    recipe = graphene.Field(RecipeItem)
+
+    def mutate(self, info, user_id, name, foods, grams, replace=False):
+        if (user_id, name) in RECIPE_LOOKUP_DB and not replace:
+            raise Exception("Recipe already exists: {} (pass replace to overwrite it)".format(name))
+        if not foods or len(foods) != len(grams):
+            raise Exception("foods and grams must be non-empty and the same length")
+        # Merge repeated foods so each recipe item maps to one food record
+        items = {}
+        for food, gram in zip(foods, grams):
+            if food not in FOOD_LOOKUP_DB:
+                raise Exception("Unknown food: {}".format(food))
+            if gram is None or not math.isfinite(gram) or gram <= 0:
+                raise Exception("Grams for {} must be a positive number".format(food))
+            items[food] = items.get(food, 0.0) + gram
+
+        RECIPE_LOOKUP_DB[(user_id, name)] = list(items.items())
+        RECIPE_CALORIE_CACHE.pop((user_id, name), None)
+        recipe_data = get_recipe_calories(user_id, name)
+        return CreateRecipe(recipe=RecipeItem(
+            name=name,
+            total_gram=recipe_data['total_gram'],
+            total_calories=recipe_data['total_calories'],
+            unit_calorie_g=recipe_data['unit_calorie_g']
+        ))
+
+class DeleteRecipe(graphene.Mutation):
+    class Arguments:
+        user_id = graphene.Int(required=True)
+        name = GString(required=True)
+
+    ok = graphene.Boolean()
+
+    def mutate(self, info, user_id, name):
+        if RECIPE_LOOKUP_DB.pop((user_id, name), None) is None:
+            raise Exception("Recipe not found: {}".format(name))
+        RECIPE_CALORIE_CACHE.pop((user_id, name), None)
+        return DeleteRecipe(ok=True)
+
 # Mutation ObjectType
 class Mutation(ObjectType):
     create_food_item = CreateFoodItem.Field()
+    create_recipe = CreateRecipe.Field()
+    delete_recipe = DeleteRecipe.Field()
 
 # Schema
 schema = Schema(query=Query, mutation=Mutation)
@@ -297,6 +410,52 @@ class ExerciseCaloriesBase(BaseModel):
 app = FastAPI()
 templates = Jinja2Templates(directory="templates")
 
+# Streaming renderer for the history pages: templates are compiled once and
+# cached as bytecode, and rendered chunk by chunk so the page head and forms
+# are sent before the record tables are finished.
+streaming_templates = Environment(
+    loader=FileSystemLoader("templates"),
+    bytecode_cache=FileSystemBytecodeCache(),
+    autoescape=True,
+    enable_async=True,
+)
+
+STREAM_BUFFER_SIZE = 8192
+# Placed in templates just before a history table so everything above it is sent before the rows are fetched
+STREAM_FLUSH_MARKER = "<!-- stream:flush -->"
+
+async def buffer_template_stream(fragments, size: int = STREAM_BUFFER_SIZE):
+    # Jinja yields one fragment per output node; join them so each write is ~size characters,
+    # except that reaching STREAM_FLUSH_MARKER sends whatever is buffered right away
+    buffer = []
+    buffered = 0
+    async for fragment in fragments:
+        buffer.append(fragment)
+        buffered += len(fragment)
+        if buffered >= size or STREAM_FLUSH_MARKER in fragment:
+            yield "".join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield "".join(buffer)
+
+def fetch_history_rows(build_query):
+    # Runs when the template reaches the table, i.e. after the endpoint has returned, so it opens
+    # its own session instead of using get_db: FastAPI only keeps yield dependencies open until the
+    # response body is sent up to 0.105, and closes them before streaming from 0.106 on.
+    # Rows are fetched with a buffered .all() and the connection goes back to the pool before any
+    # row is rendered, so a slow client does not hold it.
+    db = SessionLocal()
+    try:
+        rows = build_query(db).all()
+    finally:
+        db.close()
+    yield from rows
+
+def stream_template(name: str, context: dict):
+    template = streaming_templates.get_template(name)
+    return StreamingResponse(buffer_template_stream(template.generate_async(context)), media_type="text/html")
+
 @app.middleware("http")
 async def db_session_middleware(request: Request, call_next):
     response = Response("Internal server error", status_code=500)
@@ -416,27 +575,27 @@ async def find_user2(email:str, db: Session = Depends(get_db)):
 @app.get("/user/metrics")
 async def user_metrics(request: Request, db: Session = Depends(get_db)):
     user = db.query(User).filter(User.user_id == current_user_id).first()
-    body_metrics_records = (
-        db.query(BodyMetrics)
-        .filter(BodyMetrics.user_id == user.user_id)
-        .options(joinedload(BodyMetrics.metric))
-        .all()
-    )
+    has_records = db.query(BodyMetrics.user_id).filter(BodyMetrics.user_id == user.user_id).first()
 
-    if not body_metrics_records:
+    if not has_records:
         raise HTTPException(status_code=404, detail="No body metrics records found for this user")
 
-    result = []
-    for record in body_metrics_records:
-        result.append({
-            "timestamp": record.timestamp,
-            "metric_index": record.metric_index,
-            "value": record.value,
-            "metric_name": record.metric.metric_name,  # Access metric_name through the relationship
-            "metric_unit": record.metric.metric_unit,  # Access metric_unit through the relationship
-        })
+    user_id = user.user_id
 
-    return templates.TemplateResponse("user_body_metrics.html", {"request": request, "user": user, "body_metrics": result})
+    # Rows of (timestamp, metric_index, value, metric_name, metric_unit), queried when the table renders
+    result = fetch_history_rows(lambda history_db: (
+        history_db.query(
+            BodyMetrics.timestamp,
+            BodyMetrics.metric_index,
+            BodyMetrics.value,
+            BodyMetricsLookup.metric_name,
+            BodyMetricsLookup.metric_unit,
+        )
+        .join(BodyMetrics.metric)
+        .filter(BodyMetrics.user_id == user_id)
+    ))
+
+    return stream_template("user_body_metrics.html", {"request": request, "user": user, "body_metrics": result})
 
 
 @app.get("/users/{user_id}/metrics")
@@ -506,58 +665,47 @@ async def find_user3(email:str, db: Session = Depends(get_db)):
 async def user_calories(request: Request, db: Session = Depends(get_db)):
     user = db.query(User).filter(User.user_id == current_user_id).first()
 
-    food_records = (
-        db.query(FoodCalories)
-        .filter(FoodCalories.user_id == user.user_id)
-        .all()
-    )
+    user_id = user.user_id
+
+    # Rows of (timestamp, food, gram, calories), queried when the table renders
+    food_records = fetch_history_rows(lambda history_db: (
+        history_db.query(FoodCalories.timestamp, FoodCalories.food, FoodCalories.gram, FoodCalories.calories)
+        .filter(FoodCalories.user_id == user_id)
+    ))
 
     # if not food_records:
     #     raise HTTPException(status_code=404, detail="No food records found for this user")
 
-    food_result = []
-    for record in food_records:
-        food_result.append({
-            "timestamp": record.timestamp,
-            "food": record.food,
-            "gram": record.gram,
-            "calories": record.calories,
-        })
-
-    exercise_records = (
-        db.query(ExerciseCalories)
-        .filter(ExerciseCalories.user_id == user.user_id)
-        .all()
-    )
+    # Rows of (timestamp, exercise, minute, calories), queried when the table renders
+    exercise_records = fetch_history_rows(lambda history_db: (
+        history_db.query(ExerciseCalories.timestamp, ExerciseCalories.exercise, ExerciseCalories.minute, ExerciseCalories.calories)
+        .filter(ExerciseCalories.user_id == user_id)
+    ))
 
     # if not exercise_records:
     #     raise HTTPException(status_code=404, detail="No exercise records found for this user")
 
-    exercise_result = []
-    for record in exercise_records:
-        exercise_result.append({
-            "timestamp": record.timestamp,
-            "exercise": record.exercise,
-            "minute": record.minute,
-            "calories": record.calories,
-        })
-
     query_all_foods = '{ listAllFoods }'
     all_food = schema.execute(query_all_foods)
 
     query_all_exercises = '{ listAllExercises }'
     all_exercise = exercise_schema.execute(query_all_exercises)
 
+    query_all_recipes = '{{ listAllRecipes(userId: {}) }}'.format(user.user_id)
+    all_recipe = schema.execute(query_all_recipes)
+
     food_options = all_food.data['listAllFoods']
     exercise_options = all_exercise.data['listAllExercises']  # Add or fetch from DB as needed
+    recipe_options = all_recipe.data['listAllRecipes']
 
-    return templates.TemplateResponse("user_calories.html", {
+    return stream_template("user_calories.html", {
             "request": request,
             "user": user,
             "food_records": food_records,
             "exercise_records": exercise_records,
             "food_options": food_options,  # passing the food options to the template
-            "exercise_options": exercise_options  # passing the exercise options to the template
+            "exercise_options": exercise_options,  # passing the exercise options to the template
+            "recipe_options": recipe_options  # passing the saved recipes to the template
         })
 
 @app.get("/users/{user_id}/calories")
@@ -595,6 +743,85 @@ async def add_food_record(user_id: int,
     return RedirectResponse(url=f"/users/{user_id}/calories", status_code=303)
 
 
+@app.post("/users/{user_id}/calories/recipe/request_add")
+async def request_to_add_recipe(user_id: int,
+                    recipe_name: str = Form(...),
+                    recipe_items: str = Form(...),
+                    replace: bool = Form(False)):
+    # recipe_items is a comma separated list of food:gram pairs, e.g. "oats:50, whole_milk:200"
+    foods = []
+    grams = []
+    try:
+        for item in recipe_items.split(","):
+            food, gram = item.split(":")
+            foods.append(food.strip())
+            grams.append(float(gram))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Recipe items must be food:gram pairs")
+
+    mutation_create_recipe = (
+        'mutation CreateRecipe($userId: Int!, $name: String!, $foods: [String]!, $grams: [Float]!, $replace: Boolean) '
+        '{ createRecipe(userId: $userId, name: $name, foods: $foods, grams: $grams, replace: $replace) '
+        '{ recipe { name } } }'
+    )
+    result = schema.execute(mutation_create_recipe,
+                            variables={"userId": user_id, "name": recipe_name, "foods": foods, "grams": grams,
+                                       "replace": replace})
+    if result.errors:
+        raise HTTPException(status_code=400, detail=str(result.errors[0]))
+    print("recipe saved")
+    return RedirectResponse(url=f"/users/{user_id}/calories", status_code=303)
+
+
+@app.post("/users/{user_id}/calories/recipe/request_delete")
+async def request_to_delete_recipe(user_id: int,
+                      recipe: str = Form(...)):
+
+    mutation_delete_recipe = (
+        'mutation DeleteRecipe($userId: Int!, $name: String!) '
+        '{ deleteRecipe(userId: $userId, name: $name) { ok } }'
+    )
+    result = schema.execute(mutation_delete_recipe, variables={"userId": user_id, "name": recipe})
+    if result.errors:
+        raise HTTPException(status_code=404, detail="Recipe not found")
+    print("recipe deleted")
+    return RedirectResponse(url=f"/users/{user_id}/calories", status_code=303)
+
+
+@app.post("/users/{user_id}/calories/recipe/add")
+async def add_recipe_record(user_id: int,
+                    recipe: str = Form(...),
+                    gram: float = Form(None),
+                    db: Session = Depends(get_db)):
+
+    timestamp = datetime.now()
+
+    recipe_data = get_recipe_calories(user_id, recipe)
+    if not recipe_data:
+        raise HTTPException(status_code=404, detail="Recipe not found")
+
+    # Log the whole recipe unless a portion in grams is given
+    scale = 1.0
+    if gram is not None:
+        if not math.isfinite(gram) or gram <= 0:
+            raise HTTPException(status_code=400, detail="Portion grams must be a positive number")
+        scale = gram / recipe_data['total_gram']
+
+    db.add_all([
+        FoodCalories(
+            user_id = user_id,
+            timestamp = timestamp,
+            food = food,
+            gram = item_gram*scale,
+            calories = item_calories*scale
+        )
+        for food, item_gram, item_calories in recipe_data['items']
+    ])
+    db.commit()
+    print("recipe records added")
+    return RedirectResponse(url=f"/users/{user_id}/calories", status_code=303)
+
+
 @app.post("/users/{user_id}/calories/exercise/add")
 async def add_exercise_record(user_id: int,
                     exercise: str = Form(...),